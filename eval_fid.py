@@ -59,6 +59,9 @@ fid.create_inception_graph(inception_path)  # load the graph into the current TF
 
 config = tf.ConfigProto()
 config.gpu_options.allow_growth = True
+# a single session for all evaluations, to avoid re-initializing the inception graph every time
+fid_sess = tf.Session(config=config)
+fid_sess.run(tf.global_variables_initializer())
 
 
 def get_fid_score():
@@ -74,9 +77,7 @@ def get_fid_score():
     all_samples = np.multiply(np.add(np.multiply(all_samples, 0.5), 0.5), 255).astype('int32')
     all_samples = all_samples.reshape((-1, N_CHANNEL, RESOLUTION, RESOLUTION)).transpose(0, 2, 3, 1)
 
-    with tf.Session(config=config) as sess:
-        sess.run(tf.global_variables_initializer())
-        mu_gen, sigma_gen = fid.calculate_activation_statistics(all_samples, sess, batch_size=BATCH_SIZE)
+    mu_gen, sigma_gen = fid.calculate_activation_statistics(all_samples, fid_sess, batch_size=BATCH_SIZE)
 
     fid_value = fid.calculate_frechet_distance(mu_gen, sigma_gen, mu_real, sigma_real)
     return fid_value
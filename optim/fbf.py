@@ -67,7 +67,8 @@ class FBF(Optimizer):
                     continue
                 else:
                     if is_empty:
-                        self.updates_copy.append(u.data.clone())
+                        # update() returns a newly allocated tensor, so it can be kept without a copy
+                        self.updates_copy.append(u)
                     # Do a gradient step
                     p.data.add_(u)
 
@@ -100,7 +101,7 @@ class FBF(Optimizer):
                 if v is None:
                     continue
                 # Update the parameters using the update saved during extrapolation
-                p.data.add_(-v)
+                p.data.sub_(v)
                 # In case of inertial FBF do convex combination with previous iterate and store the current one
                 if have_inertia:
                     if no_old:
@@ -293,4 +294,5 @@ class FBFAdam(FBF):
         bias_correction2 = 1 - beta2 ** state['step']
         step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
 
-        return -step_size*exp_avg/denom
+        # denom is a temporary, reuse its memory for the update
+        return torch.div(exp_avg, denom, out=denom).mul_(-step_size)
@@ -308,10 +308,8 @@ while n_gen_update < N_ITER:
         else:
             n_gen_update += 1
             gen_optimizer.step()
-            for j, param in enumerate(gen.parameters()):
-                gen_param_avg[j] = gen_param_avg[j]*n_gen_update/(n_gen_update+1.) + \
-                    param.data.clone()/(n_gen_update+1.)
-                gen_param_ema[j] = gen_param_ema[j]*BETA_EMA + param.data.clone()*(1-BETA_EMA)
+            utils.update_average_(gen_param_avg, gen.parameters(), 1./(n_gen_update+1.))
+            utils.update_average_(gen_param_ema, gen.parameters(), 1-BETA_EMA)
 
         for p in dis.parameters():
             p.requires_grad = True
@@ -25,7 +25,6 @@
 # Michael Sedlmayer (michael.sedlmayer@univie.ac.at).
 
 import torch
-from torch.autograd import Variable
 import time
 import torchvision
 import torchvision.transforms as transforms
@@ -36,6 +35,9 @@ import json
 import csv
 import sys
 import pdb
+import copy
+import warnings
+import concurrent.futures
 
 import models
 import utils
@@ -66,17 +68,22 @@ parser.add_argument('--batchnorm-dis', action='store_true')
 parser.add_argument('--seed', default=1318, type=int)
 parser.add_argument('--tensorboard', action='store_true')
 parser.add_argument('--inception-score', action='store_true')
+parser.add_argument('--fp16-eval', action='store_true')
+parser.add_argument('--amp', action='store_true')
 parser.add_argument('--default', action='store_true')
 parser.add_argument('--inertia', default=0.0, type=float)
 parser.add_argument('-pi', '--power-iter', default=1, type=int)
 args = parser.parse_args()
 
 CUDA = args.cuda
+DEVICE = 'cuda:0' if CUDA else 'cpu'
 MODEL = args.model
 GRADIENT_PENALTY = args.gradient_penalty
 OUTPUT_PATH = args.output
 TENSORBOARD_FLAG = args.tensorboard
 INCEPTION_SCORE_FLAG = args.inception_score
+FP16_EVAL = args.fp16_eval
+AMP = args.amp
 CLIP = args.clip
 PROX = args.prox
 REG_PARAM = args.reg_param
@@ -85,9 +92,15 @@ INERTIA = args.inertia
 DEFAULT = args.default
 POWER_ITER = args.power_iter
 
+if AMP and not CUDA:
+    raise ValueError("Mixed precision training requires --cuda.")
+if FP16_EVAL and not CUDA:
+    raise ValueError("Half precision evaluation requires --cuda.")
+
 SEED = args.seed
 torch.manual_seed(SEED)
 np.random.seed(SEED)
+torch.backends.cudnn.benchmark = True
 BATCH_SIZE = args.batch_size
 
 
@@ -153,7 +166,7 @@ else:
                                '%s/lrd=%.1e_lrg=%.1e/inertia=%.2f/s%i/%i' % ('fbf_adam',
                                                                 LEARNING_RATE_D, LEARNING_RATE_G,
                                                                 INERTIA, SEED, int(time.time())))
-print OUTPUT_PATH
+print(OUTPUT_PATH)
 
 if TENSORBOARD_FLAG:
     from tensorboardX import SummaryWriter
@@ -163,12 +176,14 @@ if TENSORBOARD_FLAG:
 transform = transforms.Compose([transforms.ToTensor(), transforms.Normalize(mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5))])
 
 trainset = torchvision.datasets.CIFAR10(root='./data', train=True, transform=transform, download=True)
-trainloader = torch.utils.data.DataLoader(trainset, batch_size=BATCH_SIZE, shuffle=True, num_workers=1)
+trainloader = torch.utils.data.DataLoader(trainset, batch_size=BATCH_SIZE, shuffle=True, num_workers=4,
+                                          pin_memory=CUDA, drop_last=True)
 
 testset = torchvision.datasets.CIFAR10(root='./data', train=False, transform=transform, download=True)
-testloader = torch.utils.data.DataLoader(testset, batch_size=BATCH_SIZE, num_workers=1)
+testloader = torch.utils.data.DataLoader(testset, batch_size=BATCH_SIZE, num_workers=4,
+                                         pin_memory=CUDA, drop_last=True)
 
-print 'Init....'
+print('Init....')
 if not os.path.exists(os.path.join(OUTPUT_PATH, 'checkpoints')):
     os.makedirs(os.path.join(OUTPUT_PATH, 'checkpoints'))
 if not os.path.exists(os.path.join(OUTPUT_PATH, 'gen')):
@@ -178,12 +193,26 @@ if INCEPTION_SCORE_FLAG:
 
     from inception_score_pytorch.inception_score import inception_score
 
+    def get_eval_generator():
+        """return the scripted generator, with the current weights of gen
+        """
+        if FP16_EVAL:
+            # copies and casts the weights into the half precision copy
+            gen_scripted.load_state_dict(gen.state_dict())
+        return gen_scripted
+
+    def sample_noise(n_samples):
+        return torch.randn(n_samples, N_LATENT, device=DEVICE,
+                           dtype=torch.half if FP16_EVAL else torch.float)
+
     def get_inception_score():
         all_samples = []
-        samples = torch.randn(N_SAMPLES, N_LATENT)
-        for i in xrange(0, N_SAMPLES, 100):
-            batch_samples = samples[i:i+100].cuda(0)
-            all_samples.append(gen(batch_samples).cpu().data.numpy())
+        with torch.no_grad():
+            gen_eval = get_eval_generator()
+            samples = sample_noise(N_SAMPLES)
+            for i in range(0, N_SAMPLES, 100):
+                batch_samples = samples[i:i+100]
+                all_samples.append(gen_eval(batch_samples).float().cpu().numpy())
 
         all_samples = np.concatenate(all_samples, axis=0)
         return inception_score(torch.from_numpy(all_samples), resize=True, cuda=True)
@@ -200,28 +229,31 @@ if INCEPTION_SCORE_FLAG:
 
     config = tf.ConfigProto()
     config.gpu_options.allow_growth = True
+    # a single session for all evaluations, to avoid re-initializing the inception graph every time
+    fid_sess = tf.Session(config=config)
+    fid_sess.run(tf.global_variables_initializer())
 
     def get_fid_score():
         all_samples = []
-        samples = torch.randn(N_SAMPLES, N_LATENT)
-        for i in xrange(0, N_SAMPLES, BATCH_SIZE):
-            samples_100 = samples[i:i+BATCH_SIZE]
-            if CUDA:
-                samples_100 = samples_100.cuda(0)
-            all_samples.append(gen(samples_100).cpu().data.numpy())
+        with torch.no_grad():
+            gen_eval = get_eval_generator()
+            # fid only uses full batches of BATCH_SIZE, so only generate those and keep the shapes fixed
+            n_samples = N_SAMPLES - N_SAMPLES % BATCH_SIZE
+            samples = sample_noise(n_samples)
+            for i in range(0, n_samples, BATCH_SIZE):
+                samples_100 = samples[i:i+BATCH_SIZE]
+                all_samples.append(gen_eval(samples_100).float().cpu().numpy())
 
         all_samples = np.concatenate(all_samples, axis=0)
         all_samples = np.multiply(np.add(np.multiply(all_samples, 0.5), 0.5), 255).astype('int32')
         all_samples = all_samples.reshape((-1, N_CHANNEL, RESOLUTION, RESOLUTION)).transpose(0, 2, 3, 1)
 
-        with tf.Session(config=config) as sess:
-            sess.run(tf.global_variables_initializer())
-            mu_gen, sigma_gen = fid.calculate_activation_statistics(all_samples, sess, batch_size=BATCH_SIZE)
+        mu_gen, sigma_gen = fid.calculate_activation_statistics(all_samples, fid_sess, batch_size=BATCH_SIZE)
 
         fid_value = fid.calculate_frechet_distance(mu_gen, sigma_gen, mu_real, sigma_real)
         return fid_value
 
-    inception_f = open(os.path.join(OUTPUT_PATH, 'inception.csv'), 'ab')
+    inception_f = utils.open_csv(os.path.join(OUTPUT_PATH, 'inception.csv'))
     inception_writter = csv.writer(inception_f)
 
 if MODEL == "resnet":
@@ -238,15 +270,34 @@ if CUDA:
 gen.apply(lambda x: utils.weight_init(x, mode='normal'))
 dis.apply(lambda x: utils.weight_init(x, mode='normal'))
 
-dis_optimizer = FBFAdam(dis.parameters(), lr=LEARNING_RATE_D, betas=(BETA_1, BETA_2), inertia = INERTIA)
+gen_params = list(gen.parameters())
+dis_params = list(dis.parameters())
+
+if INCEPTION_SCORE_FLAG:
+    # with FP16_EVAL a half precision copy, its weights are refreshed from gen before each evaluation,
+    # otherwise gen itself, the scripted module shares its parameters so it only has to be compiled once
+    gen_eval = copy.deepcopy(gen).half() if FP16_EVAL else gen
+    try:
+        gen_scripted = torch.jit.script(gen_eval)
+    except Exception as e:
+        warnings.warn('Could not script the generator, evaluating it in eager mode: %s' % e)
+        gen_scripted = gen_eval
+
+dis_optimizer = FBFAdam(dis_params, lr=LEARNING_RATE_D, betas=(BETA_1, BETA_2), inertia = INERTIA)
 ## for generator FBF and Extragradient is the same in theory (when no projection is involved)
-gen_optimizer = FBFAdam(gen.parameters(), lr=LEARNING_RATE_G, betas=(BETA_1, BETA_2), inertia = INERTIA)
+gen_optimizer = FBFAdam(gen_params, lr=LEARNING_RATE_G, betas=(BETA_1, BETA_2), inertia = INERTIA)
 
-with open(os.path.join(OUTPUT_PATH, 'config.json'), 'wb') as f:
+if AMP:
+    from torch.cuda.amp import autocast, GradScaler
+    scaler = GradScaler()
+else:
+    autocast = utils.null_context
+
+with open(os.path.join(OUTPUT_PATH, 'config.json'), 'w') as f:
     json.dump(vars(args), f)
 
 dataiter = iter(testloader)
-examples, labels = dataiter.next()
+examples, labels = next(dataiter)
 torchvision.utils.save_image(utils.unormalize(examples), os.path.join(OUTPUT_PATH, 'examples.png'), 10)
 
 z_examples = utils.sample(DISTRIBUTION, (100, N_LATENT))
@@ -255,44 +306,53 @@ if CUDA:
 
 gen_param_avg = []
 gen_param_ema = []
-for param in gen.parameters():
+for param in gen_params:
     gen_param_avg.append(param.data.clone())
     gen_param_ema.append(param.data.clone())
 
-f = open(os.path.join(OUTPUT_PATH, 'results.csv'), 'ab')
+f = utils.open_csv(os.path.join(OUTPUT_PATH, 'results.csv'))
 f_writter = csv.writer(f)
 
-print 'Training...'
-numel_weights = sum(p.numel() for p in dis.parameters())
+# checkpoints are written in the background, at most one at a time
+ckpt_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+ckpt_future = None
+
+print('Training...')
+numel_weights = sum(p.numel() for p in dis_params)
 n_iteration_t = 0
 gen_inception_score = 0
 gen_fid_score = 0
 # initialize eigenvectors
-len_params = sum(1 for _ in dis.parameters())
+len_params = len(dis_params)
 u = [None] * len_params
 while n_gen_update < N_ITER:
     t = time.time()
-    avg_loss_G = 0
-    avg_loss_D = 0
-    avg_penalty = 0
+    # accumulated on the device so that the losses are only synchronized once per epoch
+    avg_loss_G = torch.zeros((), device=DEVICE)
+    avg_loss_D = torch.zeros((), device=DEVICE)
+    avg_penalty = torch.zeros((), device=DEVICE)
     num_samples = 0
-    penalty = Variable(torch.Tensor([0.]))
-    if CUDA:
-        penalty = penalty.cuda(0)
+    penalty = torch.zeros((), device=DEVICE)
     for i, data in enumerate(trainloader):
         _t = time.time()
         x_true, _ = data
-        x_true = Variable(x_true)
 
-        z = Variable(utils.sample(DISTRIBUTION, (len(x_true), N_LATENT)))
+        z = utils.sample(DISTRIBUTION, (len(x_true), N_LATENT))
         if CUDA:
-            x_true = x_true.cuda(0)
-            z = z.cuda(0)
-
-        x_gen = gen(z)
-        p_true, p_gen = dis(x_true), dis(x_gen)
-
-        gen_loss = utils.compute_gan_loss(p_true, p_gen, mode=MODE)
+            x_true = x_true.cuda(0, non_blocking=True)
+            z = z.cuda(0, non_blocking=True)
+
+        with autocast():
+            x_gen = gen(z)
+            if BATCH_NORM_D:
+                p_true, p_gen = dis(x_true), dis(x_gen)
+            else:
+                # a single forward pass on real and fake samples, not possible with batchnorm as it would mix
+                # the statistics of both batches
+                p_true, p_gen = dis(torch.cat([x_true, x_gen], dim=0)).chunk(2, dim=0)
+
+        # the losses and the gradient penalty are computed in full precision
+        gen_loss = utils.compute_gan_loss(p_true.float(), p_gen.float(), mode=MODE)
         dis_loss = - gen_loss.clone()
         if GRADIENT_PENALTY:
             penalty = dis.get_penalty(x_true.data, x_gen.data)
@@ -301,59 +361,67 @@ while n_gen_update < N_ITER:
             L1_reg = dis.get_1norm() # won't be differentiated
             dis_loss += L1_reg * REG_PARAM
 
-        for p in gen.parameters():
-            p.requires_grad = False
         dis_optimizer.zero_grad()
-        dis_loss.backward(retain_graph=True)
+        gen_optimizer.zero_grad()
+        # gen_loss = -dis_loss up to terms that do not depend on the generator, so a single backward pass
+        # gives the gradients of both players, the ones of the generator only need their sign flipped
+        if AMP:
+            scaler.scale(dis_loss).backward()
+            # FBF needs the true gradients for both its extrapolation and step, so they are unscaled here
+            # instead of going through scaler.step
+            scaler.unscale_(dis_optimizer)
+            scaler.unscale_(gen_optimizer)
+        else:
+            dis_loss.backward()
+        for p in gen_params:
+            if p.grad is not None:
+                p.grad.neg_()
+        if AMP:
+            # unscale_ has already recorded the overflow checks, they are read before update() resets them;
+            # the .item() is a host sync, the same one scaler.step would do to decide whether to skip
+            found_inf = sum(v for opt in (dis_optimizer, gen_optimizer)
+                            for v in scaler._found_inf_per_device(opt).values()).item()
+            scaler.update()
+            if found_inf:
+                # overflow with the current loss scale, which update() has lowered, retry on the next batch
+                continue
 
         if (n_iteration_t+1) % 2 != 0:
             dis_optimizer.extrapolation()
             if MODE == 'wgan':
                 nonzeros = 0.
-                for i, (param_type, p) in enumerate(dis.state_dict().items()):
-                    if REG_PARAM:
-                        if PROX == '1norm':
-                            p.data = utils.prox_1norm(p.data, REG_PARAM*LEARNING_RATE_D)
-                            nonzeros += p.nonzero().size(0)
-                        else:
-                            raise("not implemented")
-                    elif SPEC_NORM:
-                        if 'weight' in param_type:
+                if REG_PARAM:
+                    if PROX == '1norm':
+                        nonzeros += utils.prox_1norm_(dis_params, REG_PARAM*LEARNING_RATE_D)
+                    else:
+                        raise NotImplementedError()
+                elif SPEC_NORM:
+                    # named_parameters and not state_dict, whose detached entries cannot be rebound
+                    for i, (param_type, p) in enumerate(dis.named_parameters()):
+                        if 'weight' in param_type and p.dim() > 1:
                             p.data, u[i] = utils.spectral_normalize(p.data, u[i], iter = POWER_ITER)
-                    elif not GRADIENT_PENALTY:
+                elif not GRADIENT_PENALTY:
+                    for p in dis.state_dict().values():
                         p.data.clamp_(-CLIP, CLIP)
         else:
             dis_optimizer.step()
 
-        for p in gen.parameters():
-            p.requires_grad = True
-
-        for p in dis.parameters():
-            p.requires_grad = False
-        gen_optimizer.zero_grad()
-        gen_loss.backward()
-
         if (n_iteration_t+1) % 2 != 0:
             gen_optimizer.extrapolation()
         else:
             n_gen_update += 1
             gen_optimizer.step()
-            for j, param in enumerate(gen.parameters()):
-                gen_param_avg[j] = gen_param_avg[j]*n_gen_update/(n_gen_update+1.) + \
-                    param.data.clone()/(n_gen_update+1.)
-                gen_param_ema[j] = gen_param_ema[j]*BETA_EMA + param.data.clone()*(1-BETA_EMA)
-
-        for p in dis.parameters():
-            p.requires_grad = True
+            utils.update_average_(gen_param_avg, gen_params, 1./(n_gen_update+1.))
+            utils.update_average_(gen_param_ema, gen_params, 1-BETA_EMA)
 
 
         total_time += time.time() - _t
 
         if (n_iteration_t+1) % 2 == 0:
 
-            avg_loss_D += dis_loss.item()*len(x_true)
-            avg_loss_G += gen_loss.item()*len(x_true)
-            avg_penalty += penalty.item()*len(x_true)
+            avg_loss_D += dis_loss.detach()*len(x_true)
+            avg_loss_G += gen_loss.detach()*len(x_true)
+            avg_penalty += penalty.detach()*len(x_true)
             num_samples += len(x_true)
 
             if n_gen_update % EVAL_FREQ == 1:
@@ -375,29 +443,34 @@ while n_gen_update < N_ITER:
                     if TENSORBOARD_FLAG:
                         writer.add_scalar('inception_score', gen_inception_score, n_gen_update)
 
-                torch.save({'args': vars(args), 'n_gen_update': n_gen_update,
-                            'total_time': total_time, 'state_gen':
-                            gen.state_dict(), 'gen_param_avg': gen_param_avg,
-                            'gen_param_ema': gen_param_ema},
-                           os.path.join(OUTPUT_PATH, "checkpoints/%i.state" %
-                                        n_gen_update))
+                if ckpt_future is not None:
+                    ckpt_future.result()  # re-raises if the previous checkpoint failed
+                # snapshot on the cpu, the averages keep being updated in-place while saving
+                ckpt_future = ckpt_pool.submit(
+                    torch.save, {'args': vars(args), 'n_gen_update': n_gen_update,
+                                 'total_time': total_time, 'state_gen':
+                                 {k: v.to('cpu', copy=True) for k, v in gen.state_dict().items()},
+                                 'gen_param_avg': [p.to('cpu', copy=True) for p in gen_param_avg],
+                                 'gen_param_ema': [p.to('cpu', copy=True) for p in gen_param_ema]},
+                    os.path.join(OUTPUT_PATH, "checkpoints/%i.state" % n_gen_update))
 
         n_iteration_t += 1
 
-    avg_loss_G /= num_samples
-    avg_loss_D /= num_samples
-    avg_penalty /= num_samples
-    nnz_perc = nonzeros/numel_weights
+    avg_loss_G = avg_loss_G.item()/num_samples
+    avg_loss_D = avg_loss_D.item()/num_samples
+    avg_penalty = avg_penalty.item()/num_samples
+    # nonzeros is a device tensor when the prox is used, only synchronized here
+    nnz_perc = float(nonzeros)/numel_weights
 
     if REG_PARAM:
-        print 'Iter: %i, Loss Gen: %.4f, Loss Dis: %.4f, NNZ: %.2f, L1norm: %.2e, IS: %.2f, FID: %.2f, Time: %.4f' % (
+        print('Iter: %i, Loss Gen: %.4f, Loss Dis: %.4f, NNZ: %.2f, L1norm: %.2e, IS: %.2f, FID: %.2f, Time: %.4f' % (
             n_gen_update, avg_loss_G, avg_loss_D, nnz_perc, L1_reg*REG_PARAM,
-            gen_inception_score, gen_fid_score, time.time() - t)
+            gen_inception_score, gen_fid_score, time.time() - t))
         f_writter.writerow((n_gen_update, avg_loss_G, avg_loss_D, nnz_perc, avg_penalty, L1_reg.item()*REG_PARAM, time.time() - t))
     else:
-        print 'Iter: %i, Loss Gen: %.4f, Loss Dis: %.4f, Penalty: %.2e, IS: %.2f, FID: %.2f, Time: %.4f' % (
+        print('Iter: %i, Loss Gen: %.4f, Loss Dis: %.4f, Penalty: %.2e, IS: %.2f, FID: %.2f, Time: %.4f' % (
                 n_gen_update, avg_loss_G, avg_loss_D, avg_penalty,
-                gen_inception_score, gen_fid_score, time.time() - t)
+                gen_inception_score, gen_fid_score, time.time() - t))
         f_writter.writerow((n_gen_update, avg_loss_G, avg_loss_D, nnz_perc, avg_penalty, time.time() - t))
 
 
@@ -410,3 +483,7 @@ while n_gen_update < N_ITER:
 
         x = torchvision.utils.make_grid(x.data, 10)
         writer.add_image('gen', x.data, n_gen_update)
+
+if ckpt_future is not None:
+    ckpt_future.result()  # re-raises if the last checkpoint failed
+ckpt_pool.shutdown()
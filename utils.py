@@ -24,12 +24,15 @@
 # modifications by Axel Boehm (axel.boehm@univie.ac.at) and
 # Michael Sedlmayer (michael.sedlmayer@univie.ac.at).
 
+import sys
+import contextlib
 import torch
 import torch.autograd as autograd
 import torch.nn as nn
 import numpy as np
 from torch import where, add, abs, zeros_like, ones_like
 import torch.nn.functional as F
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 
 
 def clip_weights(params, clip=0.01):
@@ -37,6 +40,34 @@ def clip_weights(params, clip=0.01):
         p.clamp_(-clip, clip)
 
 
+def update_average_(avgs, params, weight):
+    """in-place update of the running averages $avgs <- (1-weight)*avgs + weight*params$
+    """
+    params = [p.data for p in params]
+    if hasattr(torch, '_foreach_mul_'):
+        # fuse the update over all tensors in a single kernel launch each
+        torch._foreach_mul_(avgs, 1. - weight)
+        torch._foreach_add_(avgs, params, alpha=weight)
+    else:
+        for avg, p in zip(avgs, params):
+            avg.mul_(1. - weight).add_(weight, p)
+
+
+@contextlib.contextmanager
+def null_context():
+    """context manager that does nothing, stands in for autocast when mixed precision is off
+    """
+    yield
+
+
+def open_csv(path):
+    """open a csv file for appending, in binary mode on python 2 and in text mode on python 3
+    """
+    if sys.version_info[0] < 3:
+        return open(path, 'ab')
+    return open(path, 'a', newline='')
+
+
 def unormalize(x):
     return x/2. + 0.5
 
@@ -88,6 +119,16 @@ def prox_1norm(data, lam):
     return data
 
 
+def prox_1norm_(params, lam):
+    """apply the proximal operator of ||.||_1 with stepsize $lam$ in-place to all params at once,
+    returns the number of nonzero entries after the prox step as a tensor on the device of params
+    """
+    flat = F.softshrink(_flatten_dense_tensors([p.data for p in params]), lam)
+    for p, p_prox in zip(params, _unflatten_dense_tensors(flat, params)):
+        p.data.copy_(p_prox)
+    return (flat != 0).sum()
+
+
 def spectral_normalize(W, u, iter=1):
 
     sigma, u = max_singular_value(W.reshape(W.shape[0], -1), u, iter)